@@ -16,6 +16,7 @@ import logging
 import tempfile
 from datetime import datetime
 import json
+import re
 
 SOH = 0x01
 NUL = 0x00
@@ -25,6 +26,8 @@ EOT = 0x04
 GO_EXECUTABLE = 'decompress_lzhuf'
 
 class B2Attachment:
+	__slots__ = ("filename", "data", "size")  # Small fixed record; no per-instance __dict__
+
 	def __init__(self, filename, size):
 		self.filename = filename  # Name of the attachment file
 		self.data = None
@@ -34,16 +37,18 @@ class B2Message:
 	def __init__(self, message_id, raw_data, decompressed_size, compressed_size, enable_debug=False) -> int:
 		self.enable_debug = enable_debug
 		self.raw_data = raw_data
+		self.raw_length = None  # Bytes of raw_data belonging to this message, known once parsed
 		self.header_length = None
 		self.subject = None
 		self.offset = None
 		self.transmitted_checksum = None
 		self.compressed_data = bytearray()
+		self._compressed_sum = 0  # Byte sum of compressed_data, accumulated as the blocks are copied
 		self.compressed_size = compressed_size
 		self.decompressed_data = None
 		self.decompressed_size = decompressed_size
 		self.headers = ""
-		self.body = ""
+		self.body = b""  # Kept as bytes; it is only ever written back out
 		self.attachments = []
 		# Header fields
 		self.message_id = message_id
@@ -55,21 +60,49 @@ class B2Message:
 		self.position = {"latitude": 0.0, "longitude": 0.0}
 		# Set up logging
 		self.logger = logging.getLogger(__name__)
-		self._setup_logging()
-
-	def _setup_logging(self):
-		"""Set up logging configuration."""
-		log_level = logging.DEBUG if self.enable_debug else logging.INFO
-		logging.basicConfig(level=log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-	def _log_debug(self, message):
-		"""Log debug messages if debugging is enabled."""
+	def _log_debug(self, message, *args):
+		"""Log debug messages if debugging is enabled; args are only formatted into message if the record is emitted."""
 		if self.enable_debug:
-			self.logger.debug(message)
+			self.logger.debug(message, *args)
+
+	@staticmethod
+	def frame_size_hint(compressed_size):
+		"""Upper bound on the wire size of a message sent in full 250-byte blocks: header, lead bytes, <STX><LEN> per block, <EOT><CHECKSUM>."""
+		return 2 + 255 + 8 + compressed_size + 2 * -(-compressed_size // 250) + 2
+
+	@staticmethod
+	def frame_end(raw_data, start=0, end=None):
+		"""Return the index just past the message that begins at start, or None if raw_data[:end] does not hold all of it yet."""
+		if end is None:
+			end = len(raw_data)
+		if start >= end:
+			return None
+		if raw_data[start] != SOH:
+			raise ValueError(f"Expected SOH at index {start}")
+		# Skip the subject and offset fields, each terminated by a NUL
+		end_subject = raw_data.find(NUL, start + 2, end)
+		if end_subject < 0:
+			return None
+		end_offset = raw_data.find(NUL, end_subject + 1, end)
+		if end_offset < 0:
+			return None
+		# Walk the <STX><LEN> blocks (including any lead-bytes block) up to <EOT><CHECKSUM>
+		byte_index = end_offset + 1
+		while byte_index < end:
+			if raw_data[byte_index] == STX:
+				if byte_index + 1 >= end:
+					return None
+				byte_index += 2 + raw_data[byte_index + 1]
+			elif raw_data[byte_index] == EOT:
+				return byte_index + 2 if byte_index + 2 <= end else None
+			else:
+				raise ValueError(f"Malformed message block at index {byte_index} -- expected STX or EOT, got 0x{raw_data[byte_index]:02X}")
+		return None
 
 	def _calculate_checksum(self) -> int:
 		"""Checksum as described: ((sum & 0xFF) * -1) & 0xFF"""
-		checksum = sum(self.compressed_data) & 0xFF
+		checksum = self._compressed_sum & 0xFF
 		return ((checksum * -1) & 0xFF)
 
 	# Returns the index of the next unprocessed byte in raw_data
@@ -78,19 +111,19 @@ class B2Message:
 		byte_index = 0
 		if self.raw_data[byte_index] != SOH:
 			raise ValueError("Expected SOH at start of message")
-		self._log_debug(f"Found SOH")
+		self._log_debug("Found SOH")
 		
 		# Position 1: One byte length field which covers the SUBJECT, a NUL, an ASCII LENGTH field called
 		# the OFFSET, and another NUL
 		byte_index += 1
 		self.header_length = self.raw_data[byte_index]
-		self._log_debug(f"Header length is <{self.header_length}>")
+		self._log_debug("Header length is <%s>", self.header_length)
 
 		# Position 2..2+Read subject
 		byte_index += 1
 		end_subject = self.raw_data.index(NUL, byte_index)
 		self.subject = self.raw_data[byte_index:end_subject].decode("ascii")
-		self._log_debug(f"Subject is <{self.subject}>")
+		self._log_debug("Subject is <%s>", self.subject)
 
 		# Another NUL
 		byte_index = end_subject
@@ -100,34 +133,41 @@ class B2Message:
 		# Read offset
 		byte_index += 1
 		end_offset = self.raw_data.index(NUL, byte_index)
-		offset_str = self.raw_data[byte_index:end_offset].decode("ascii")
-		self.offset = int(offset_str)
-		self._log_debug(f"Offset is {self.offset}")
+		self.offset = int(self.raw_data[byte_index:end_offset])  # int() parses the ASCII digits directly; no str needed
+		self._log_debug("Offset is %s", self.offset)
 
 		byte_index = end_offset + 1  # end_offset points to NUL; skip over it
-		# compressed_index = 0
+		raw_view = memoryview(self.raw_data)  # Blocks are copied out of this without intermediate bytes objects
+		# Sized from the proposal, but never beyond the frame that carries it; trimmed below if the blocks come up short
+		self.compressed_data = bytearray(min(self.compressed_size, len(self.raw_data)))
+		compressed_index = 0
+		self._compressed_sum = 0
 		if self.offset != 0:
 			if self.raw_data[byte_index] != STX or self.raw_data[byte_index+1] != 0x06:
 				raise ValueError("Expected STX 0x06 before lead-bytes")
 			byte_index += 2
-			self.compressed_data[0:6] = self.raw_data[byte_index:byte_index+6] # these are the "lead bytes" and this probably
-																			   # NOT the right way to handle them
+			self.compressed_data[0:6] = raw_view[byte_index:byte_index+6] # these are the "lead bytes" and this probably
+																		  # NOT the right way to handle them
+			compressed_index = 6
+			self._compressed_sum += sum(raw_view[byte_index:byte_index+6])
 			byte_index += 6
 
 		while True: 
 			if self.raw_data[byte_index] == STX:
-				self._log_debug(f"Found STX at index {byte_index}")
+				self._log_debug("Found STX at index %s", byte_index)
 				byte_index += 1
 				stx_block_length = self.raw_data[byte_index] # from byte following this one to the next <STX> or <EOT>
-				self._log_debug(f"Found LENGTH of {stx_block_length} at index {byte_index}")
+				self._log_debug("Found LENGTH of %s at index %s", stx_block_length, byte_index)
 				byte_index += 1  # pointing to first data byte
 
-				self._log_debug(f"Expecting compressed block of {stx_block_length} bytes at index {byte_index}")
-				self.compressed_data.extend(self.raw_data[byte_index:byte_index+stx_block_length])
+				self._log_debug("Expecting compressed block of %s bytes at index %s", stx_block_length, byte_index)
+				self.compressed_data[compressed_index:compressed_index+stx_block_length] = raw_view[byte_index:byte_index+stx_block_length]
+				compressed_index += stx_block_length
+				self._compressed_sum += sum(raw_view[byte_index:byte_index+stx_block_length])  # Summed while the block is hot, not in a second pass
 				byte_index += stx_block_length
-				self._log_debug(f"Captured block of length {stx_block_length}")
+				self._log_debug("Captured block of length %s", stx_block_length)
 			elif self.raw_data[byte_index] == EOT:
-				self._log_debug(f"Found EOT at index {byte_index}")
+				self._log_debug("Found EOT at index %s", byte_index)
 				byte_index += 1
 				self.transmitted_checksum = self.raw_data[byte_index]
 				calculated_checksum = self._calculate_checksum()
@@ -135,108 +175,136 @@ class B2Message:
 				if self.transmitted_checksum != calculated_checksum:
 					raise ValueError(f"Checksum mismatch: expected 0x{calculated_checksum:02X}, got 0x{self.transmitted_checksum:02X}")
 				else:
-					self._log_debug(f"Checksum match")
+					self._log_debug("Checksum match")
 					break
 			else:
 				raise ValueError(f"Malformed message block at index {byte_index} -- expected STX or EOT, got 0x{self.raw_data[byte_index]:02X}")
 
 		# CRC-16, LENGTH, and compressed message
+		del self.compressed_data[compressed_index:]  # Drop any unfilled tail so a short message fails the size check
 		compressed_data_len = len(self.compressed_data)  # Data begins after the <STX><LEN> and ends before <EOT><CHECKSUM>
 		if compressed_data_len == self.compressed_size:
-			self._log_debug(f"Compressed message plus header matches proposal: {compressed_data_len}")
+			self._log_debug("Compressed message plus header matches proposal: %s", compressed_data_len)
 		else:
 			raise ValueError(f"Compressed message size {compressed_data_len} does not match proposal {self.compressed_size}")
 
 		decompressed_data_len = int.from_bytes(self.compressed_data[2:6], byteorder='little')
 		if decompressed_data_len == self.decompressed_size:
-			self._log_debug(f"Decompressed message size matches proposal: {decompressed_data_len}")
+			self._log_debug("Decompressed message size matches proposal: %s", decompressed_data_len)
 		else:
 			raise ValueError(f"Decompressed message size {decompressed_data_len} does not match proposal {self.decompressed_size}")
 
+		# The helper only works on named files, so the data makes one trip through two temp files, removed afterwards
+		compressed_file_name = decompressed_file_name = None
 		try:
 			with tempfile.NamedTemporaryFile(delete=False, mode='wb') as compressed_file:
 				compressed_file_name = compressed_file.name
 				compressed_file.write(self.compressed_data)
-				compressed_file.close()
-				with open(compressed_file_name, 'rb') as compressed_file:
-					with tempfile.NamedTemporaryFile(delete=False, mode='w') as decompressed_file:
-						decompressed_file_name = decompressed_file.name
-						result = subprocess.run([GO_EXECUTABLE, compressed_file_name, decompressed_file_name], capture_output=True, text=True)
-						decompressed_file.close()
-						with open(decompressed_file_name, 'rb') as decompressed_file:
-							self.decompressed_data = decompressed_file.read()   #.decode('ascii', errors='ignore')
-							self._extract_message_parts()
+			with tempfile.NamedTemporaryFile(delete=False, mode='wb') as decompressed_file:
+				decompressed_file_name = decompressed_file.name
+			# The helper's console output is never looked at, so don't pipe and decode it; a failed run raises
+			subprocess.run([GO_EXECUTABLE, compressed_file_name, decompressed_file_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+			with open(decompressed_file_name, 'rb') as decompressed_file:
+				self.decompressed_data = decompressed_file.read()   #.decode('ascii', errors='ignore')
+			self._extract_message_parts()
 		except Exception as e:
-			self.logger.error(f"Decompression failed: {e}")
-		self._log_debug(f"JSON: {self.json_header()}")
+			self.logger.error("Decompression failed: %s", e)
+		finally:
+			for temp_file_name in (compressed_file_name, decompressed_file_name):
+				if temp_file_name:
+					try:
+						os.unlink(temp_file_name)
+					except OSError:
+						pass
+		if self.enable_debug:  # Skip building the JSON dump unless it will be logged
+			self._log_debug("JSON: %s", self.json_header())
+		self.raw_length = byte_index
 		return byte_index  # Returns the index of the next unprocessed byte in raw_data
 
 	def _extract_message_parts(self):
 		"""Extract headers and body from the decompressed data."""
 		if self.decompressed_data:
 
-			header_binary, body_and_attachments_binary = self.decompressed_data.split(b"\r\n\r\n", 1)
-			split_list = body_and_attachments_binary.split(b"\r\n", 1)
-			body_binary = split_list[0] if len(split_list) > 0 else b""
-			attachment_binary = split_list[1] if len(split_list) > 1 else b""
+			header_binary, _, body_and_attachments_binary = self.decompressed_data.partition(b"\r\n\r\n")
+			body_binary, _, attachment_binary = body_and_attachments_binary.partition(b"\r\n")
 			self.headers = header_binary.decode('ascii', errors='ignore') 
-			header_lines = self.headers.split("\n")
 			self.body_length = 0
-			for line in header_lines:
-				parts = line.split()
-				part = line.split(" ",1)
-				# Body: 28
-				# Date: 2025/08/08 20:40
-				# From: W6EI-2
-				# Subject: Test
-				# To: BOB
-				# File: 21385 39D0D08F-D670-435E-AEB6-FE2A2936E900.jpg
-				# X-Location: 37.420281N, 122.120632W (GPS)
-				if line.startswith("Body: "):
-					self.body_length = int(parts[1]) if len(parts) > 1 else 0
-				elif line.startswith("Date: "):  # Date: 2025/08/08 20:40
-					self.date = datetime.strptime(part[1], "%Y/%m/%d %H:%M") if len(part) > 1 else datetime.now()
-				elif line.startswith("From: "):
-					self.sender = part[1] if len(part) > 1 else "Unknown"
-				elif line.startswith("Subject: "):
-					self.subject = part[1] if len(part) > 1 else "Unknown"
-				elif line.startswith("To: "):
-					self.recipient = part[1] if len(part) > 1 else "Unknown"
-				elif line.startswith("X-Location: "):
-					i = line.replace(",", "").split()
-					if len(i) == 4:
-						lat = float(i[1][:-1])
-						if i[1][-1] == "N":
-							latitude = lat
-						else:
-							latitude = 0 - lat
-						lon = i[2][:-1]
-						if i[2][-1] == "E":
-							longitude = lon
-						else:
-							longitude = 0 - lon
-						self.position = { "latitude": latitude, "longitude": longitude}
-					else:
-						self.position = {"latitude": 0.0, "longitude": 0.0}
-					self.to = part[1] if len(part) > 1 else "Unknown"
-				elif line.startswith("File: "):
-					b2attachment = B2Attachment(parts[2], int(parts[1]))
-					self.attachments.append(b2attachment)
+			for match in self._HEADER_PATTERN.finditer(self.headers):  # One scan finds just the lines we handle
+				self._HEADER_HANDLERS[match.group(1)](self, match.group(2))
 			if self.body_length == 0:
-				self.body = ""
+				self.body = b""
 			else:
-				self.body = body_binary.decode('ascii', errors='ignore')
+				self.body = body_binary
 
+			attachment_index = 0  # Start of the next attachment in attachment_binary
 			for attachment in self.attachments:
-				self._log_debug(f"Attachment expected size {attachment.size} Available {len(attachment_binary)}")
-				if attachment.size + 2 <= len(attachment_binary):
-					attachment.data = attachment_binary[:attachment.size]
-					self._log_debug(f"Extracted attachment {attachment.filename} of size {attachment.size}")
-					# Remove the extracted data from the binary stream
-					attachment_binary = attachment_binary[attachment.size+2:]
+				available = len(attachment_binary) - attachment_index
+				self._log_debug("Attachment expected size %s Available %s", attachment.size, available)
+				if attachment.size + 2 <= available:
+					attachment.data = attachment_binary[attachment_index:attachment_index+attachment.size]
+					self._log_debug("Extracted attachment %s of size %s", attachment.filename, attachment.size)
+					# Step past the extracted data and its trailing \r\n rather than copying the rest of the stream
+					attachment_index += attachment.size + 2
 		else:
 			self.logger.error("Decompressed data is empty, cannot extract headers and body.")
 
+	# Body: 28
+	def _header_body(self, value):
+		self.body_length = int(value) if value else 0
+
+	# Date: 2025/08/08 20:40
+	def _header_date(self, value):
+		self.date = datetime.strptime(value, "%Y/%m/%d %H:%M") if value else datetime.now()
+
+	# From: W6EI-2
+	def _header_from(self, value):
+		self.sender = value or "Unknown"
+
+	# Subject: Test
+	def _header_subject(self, value):
+		self.subject = value or "Unknown"
+
+	# To: BOB
+	def _header_to(self, value):
+		self.recipient = value or "Unknown"
+
+	# X-Location: 37.420281N, 122.120632W (GPS)
+	def _header_location(self, value):
+		i = value.replace(",", "").split()
+		if len(i) == 3:
+			lat = float(i[0][:-1])
+			if i[0][-1] == "N":
+				latitude = lat
+			else:
+				latitude = 0 - lat
+			lon = float(i[1][:-1])
+			if i[1][-1] == "E":
+				longitude = lon
+			else:
+				longitude = 0 - lon
+			self.position = { "latitude": latitude, "longitude": longitude}
+		else:
+			self.position = {"latitude": 0.0, "longitude": 0.0}
+
+	# File: 21385 39D0D08F-D670-435E-AEB6-FE2A2936E900.jpg
+	def _header_file(self, value):
+		file_parts = value.split()  # <size> <filename>
+		b2attachment = B2Attachment(file_parts[1], int(file_parts[0]))
+		self.attachments.append(b2attachment)
+
+	# Header lines are "<Key>: <value>"; keys not listed here are ignored
+	_HEADER_HANDLERS = {
+		"Body": _header_body,
+		"Date": _header_date,
+		"From": _header_from,
+		"Subject": _header_subject,
+		"To": _header_to,
+		"X-Location": _header_location,
+		"File": _header_file,
+	}
+	# Matches a whole "<Key>: <value>" line for the keys above; header lines end in \r\n
+	_HEADER_PATTERN = re.compile(r"^(%s): (.*?)\r?$" % "|".join(map(re.escape, _HEADER_HANDLERS)), re.MULTILINE)
+
 	def json_header(self):
 		'''Produce JSON string of message header information'''
 		python_dict = {
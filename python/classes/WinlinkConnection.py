@@ -8,23 +8,45 @@ __maintainer__ = __author__
 __email__ = "bob@rail.com"
 __status__ = "Experimental"
 
-# State definitions for the state machine as strings
 import logging
-import queue
 import re 
 import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from classes.B2Message import B2Message
 from classes.WinlinkMailMessage import WinlinkMailMessage
-import traceback
 
-START = "START"
-CONNECTED = "CONNECTED"
-CALLSIGN_ENTRY = "CALLSIGN_ENTRY"
-PASSWORD_VALIDATION = "PASSWORD_VALIDATION"
-LOGIN_SUCCESS = "LOGIN_SUCCESS"
-CLIENT_REQUEST = "CLIENT_REQUEST"
-CLOSE_CONNECTION = "CLOSE_CONNECTION"
+# State definitions for the state machine as small integers
+class ConnectionState(IntEnum):
+	START = 0
+	CONNECTED = 1
+	CALLSIGN_ENTRY = 2
+	PASSWORD_VALIDATION = 3
+	LOGIN_SUCCESS = 4
+	CLIENT_REQUEST = 5
+	CLOSE_CONNECTION = 6
 
-MAILBOX_FOLDER_NAME = "mailbox"
+START, CONNECTED, CALLSIGN_ENTRY, PASSWORD_VALIDATION, LOGIN_SUCCESS, CLIENT_REQUEST, CLOSE_CONNECTION = ConnectionState
+
+# Fixed replies, encoded once
+CALLSIGN_PROMPT = b"Callsign :\r"
+PASSWORD_PROMPT = b"Password :\r"
+LOGIN_BANNER = b"[AREDN_BRIDGE-1.0-B2F$]\rCMS>\r"
+MESSAGES_RECEIVED = b"FF\r"
+NO_MORE_MESSAGES = b"FQ\r"
+
+# FC <type> <message id> <uncompressed size> <compressed size> [...]
+PROPOSAL_PATTERN = re.compile(r"FC\s+(\S+)\s+(\S+)\s+(\d{1,10})\s+(\d{1,10})(?:\s|$)")
+
+# Callsign/password prompts allowed before login completes; a silent client is then dropped so it can't hold a worker forever
+LOGIN_PROMPT_MAX = 10
+
+# Proposal sizes come from the client, so they only size the first receive buffer up to this; it doubles as data arrives
+MESSAGE_BUFFER_START_MAX = 1 << 20
+
+MAILBOX_WRITER_THREADS = 2  # Shared by all connections so disk writes never hold up the protocol exchange
+_mailbox_writer = ThreadPoolExecutor(max_workers=MAILBOX_WRITER_THREADS, thread_name_prefix="mailbox-writer")
 
 
 class WinlinkConnection:
@@ -33,6 +55,7 @@ class WinlinkConnection:
 		self.connection = connection
 		self.address = address
 		self.timeout = timeout  # Unified timeout value for all operations
+		self.connection.settimeout(self.timeout)  # Set once; it applies to every read on this connection
 		self.enable_debug = enable_debug
 		self.client_callsign = None
 		self.client_password = None  
@@ -43,88 +66,101 @@ class WinlinkConnection:
 		self.next_state = START  
 		self.forward_login_callsign = None  
 		self.pickup_callsigns = []  
-		self.message_queue = queue.Queue()  
+		self.message_queue = deque()  # Only this connection's thread touches it, so no locking is needed
+		self._receive_buffer = bytearray()  # Bytes received but not yet consumed as a line or message data
+		self._dead = False  # Set by the first failed send, or when the client closes; nothing more is sent or read after that
+		self._login_prompts = 0  # Callsign and password prompts sent so far
+
+		# Each state is handled by one method, which sets next_state; indexed by state, in ConnectionState order
+		self._state_handlers = [
+			self._handle_start,  # START
+			self._handle_connected,  # CONNECTED
+			self._handle_callsign_entry,  # CALLSIGN_ENTRY
+			self._handle_password_validation,  # PASSWORD_VALIDATION
+			self._handle_login_success,  # LOGIN_SUCCESS
+			self._handle_client_request,  # CLIENT_REQUEST
+		]
+
+		# Client requests are dispatched on their 2- or 4-character command prefix
+		self._request_handlers = {
+			"FC": self._handle_message_proposal,
+			"F>": self._handle_end_of_proposals,
+			"FF": self._handle_no_messages,
+			"; ": self._handle_comment,
+			";FW:": self._handle_forward_message,
+			";PQ:": self._handle_authentication_challenge,
+			";PM:": self._handle_pending_message,
+		}
 		
 		# Set up logging
 		self.logger = logging.getLogger(__name__)
-		self._setup_logging()
 
-	def _setup_logging(self):
-		"""Set up logging configuration."""
-		log_level = logging.DEBUG if self.enable_debug else logging.INFO
-		logging.basicConfig(level=log_level,
-							format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-		
-	def _log_debug(self, message):
-		"""Log debug messages if debugging is enabled."""
+	def _log_debug(self, message, *args):
+		"""Log debug messages if debugging is enabled; args are only formatted into message if the record is emitted."""
 		if self.enable_debug:
-			self.logger.debug(message)
+			self.logger.debug(message, *args)
 
 	def _log_state_change(self, new_state):
 		"""Log the state change."""
 		if self.state != new_state:
-			self._log_debug(f"State changed from {self.state} to {new_state}")
+			self._log_debug("State changed from %s to %s", self.state.name, new_state.name)
 			self.state = new_state  # Update the current state
 
 	def handle_connection(self):
 		"""Main loop to handle connection and state transitions."""
 		try:
-			while self.state != CLOSE_CONNECTION:  # Continue processing until CLOSE_CONNECTION state is reached
-				if self.state == START:
-					self._handle_start()
-				elif self.state == CONNECTED:
-					self._handle_connected()
-				elif self.state == CALLSIGN_ENTRY:
-					self._handle_callsign_entry()
-				elif self.state == PASSWORD_VALIDATION:
-					self._handle_password_validation()
-				elif self.state == LOGIN_SUCCESS:
-					self._handle_login_success()
-				elif self.state == CLIENT_REQUEST:
-					self._handle_client_request()
-				else:
-					self._log_debug("Unknown state")
-					break
+			while self.state != CLOSE_CONNECTION and not self._dead:  # Continue until CLOSE_CONNECTION or the client is gone
+				self._state_handlers[self.state]()
 
 				# Set the state to the next state after the method finishes
 				self._log_state_change(self.next_state)
 		except Exception as e:
-			self.logger.error(f"Error during connection handling: {e}")
+			self.logger.error("Error during connection handling: %s", e)
 		finally:
 			# Ensure the connection is closed at the end of the method
 			self._close_connection()
 
 	def send_data(self, data):
-		"""Send data back to the client."""
+		"""Send already-encoded data back to the client."""
+		if self._dead:
+			return
 		try:
 			if self.connection:
-				self.connection.sendall(data.encode())
-				if len(data) > 0:
-					self._log_debug(f"Sent: <{data.strip()}>")
-		except Exception as e:
-			self.logger.error(f"Error sending data: {e}")
-
-	def wait_for_input(self, prompt):
-		"""Send prompt and wait for client response, terminated by a carriage return."""
-		self.send_data(prompt)
+				self.connection.sendall(data)
+				if self.enable_debug and len(data) > 0:
+					self._log_debug("Sent: <%s>", data.decode().strip())
+		except OSError as e:
+			self.logger.error("Error sending data: %s", e)
+			self._dead = True  # The connection is unusable; stop the state machine rather than fail every later send
+			self.next_state = CLOSE_CONNECTION
+
+	def wait_for_input(self, prompt=b""):
+		"""Send the (already-encoded) prompt, if any, and wait for client response, terminated by a carriage return."""
+		if prompt:
+			self.send_data(prompt)
+		if self._dead:
+			return None
 		try:
-			self.connection.settimeout(self.timeout)  # Set the timeout for the connection
-			response = b""
-			
-			# Keep reading until a carriage return (\r) is encountered
-			while True:
-				byte = self.connection.recv(1)  # Read one byte at a time
-				if not byte:
+			# Read in blocks until a carriage return (\r) is buffered; anything after it is kept for the next call
+			end_of_line = self._receive_buffer.find(b'\r')
+			while end_of_line < 0:
+				chunk = self.connection.recv(4096)
+				if not chunk:
+					if not self._receive_buffer:
+						self._log_debug("Connection closed by client")
+						self._dead = True  # Nothing more can arrive
+						return None
 					break  # If there's no data, stop reading
-				response += byte
-				if byte == b'\r':  # Carriage return indicates the end of the line
-					break
+				self._receive_buffer.extend(chunk)
+				end_of_line = self._receive_buffer.find(b'\r', len(self._receive_buffer) - len(chunk))
+			if end_of_line < 0:
+				end_of_line = len(self._receive_buffer)  # Connection closed mid-line; take what arrived
 
-			response_str = response.decode()  # Convert bytes to a string
-			response_str = response_str.rstrip("\r")  # Strip the carriage return
+			response_str = self._receive_buffer[:end_of_line].decode()  # Convert bytes to a string
+			del self._receive_buffer[:end_of_line + 1]  # Consume the line and its carriage return
 
 			# Debug: Log the received data for inspection
-			self._log_debug(f"Received: <{response_str}>")
+			self._log_debug("Received: <%s>", response_str)
 
 			return response_str
 		except socket.timeout:
@@ -146,60 +182,56 @@ class WinlinkConnection:
 	def _handle_callsign_entry(self):
 		"""Process the callsign."""
 		self._log_debug("CALLSIGN_ENTRY state")
-		callsign = self.wait_for_input("Callsign :\r")  # Wait for client input
+		self._login_prompts += 1
+		callsign = self.wait_for_input(CALLSIGN_PROMPT)  # Wait for client input
 
 		if callsign:
 			self.client_callsign = callsign  # Save the callsign
 			self.next_state = PASSWORD_VALIDATION  # Move to PASSWORD_VALIDATION state
 		else:
-			self.next_state = START  # Return to the START state
+			self._retry_login()
 
 	def _handle_password_validation(self):
 		"""Process the password."""
 		self._log_debug("PASSWORD_VALIDATION state")
 		# Prompt for password and wait for input
-		password = self.wait_for_input("Password :\r")
+		self._login_prompts += 1
+		password = self.wait_for_input(PASSWORD_PROMPT)
 		
 		if password:
 			self.client_password = password  # Save the password as an instance variable
 			self.next_state = LOGIN_SUCCESS  # Move to LOGIN_SUCCESS state
 		else:
+			self._retry_login()
+
+	def _retry_login(self):
+		"""Start the login over, unless the client has already had its share of prompts."""
+		if self._login_prompts < LOGIN_PROMPT_MAX:
 			self.next_state = START  # Return to the START state
+		else:
+			self._log_debug("No login after %s prompts. Closing connection to %s", self._login_prompts, self.address)
+			self.next_state = CLOSE_CONNECTION
 
 	def _handle_login_success(self):
 		"""Handle successful login."""
 		self._log_debug("LOGIN_SUCCESS state")
 		
-		# Send '[AREDN_BRIDGE-1.0-B2F$]' followed by a carriage return
-		self.send_data("[AREDN_BRIDGE-1.0-B2F$]\r")
-		
-		# Send 'CMS>' followed by a carriage return
-		self.send_data("CMS>\r")
+		# Send '[AREDN_BRIDGE-1.0-B2F$]' and 'CMS>', each followed by a carriage return, in a single write
+		self.send_data(LOGIN_BANNER)
 		
 		self.next_state = CLIENT_REQUEST  # Transition to CLIENT_REQUEST after login success
 
 	def _handle_client_request(self):
 		"""Handle the client's request after login."""
 		self._log_debug("CLIENT_REQUEST state")
-		request = self.wait_for_input("")  # Wait for client's request and strip trailing carriage return
+		request = self.wait_for_input()  # Wait for client's request and strip trailing carriage return
 
 		if request:
-			if request.startswith("FC"):  
-				self._handle_message_proposal(request)  
-			elif request.startswith(";FW:"):
-				self._handle_forward_message(request)  
-			elif request.startswith(";PQ:"):
-				self._handle_authentication_challenge(request)  
-			elif request.startswith(";PM:"):
-				self._handle_pending_message(request)  
-			elif re.match(r"^\[.*\]$", request):  
-				self._handle_sid(request)  
-			elif request.startswith("; "):
-				self._handle_comment(request)  
-			elif request.startswith("F>"):
-				self._handle_end_of_proposals(request)  
-			elif request.startswith("FF"):  
-				self._handle_no_messages(request)  
+			handler = self._request_handlers.get(request[:2]) or self._request_handlers.get(request[:4])
+			if handler is None and request.startswith("[") and request.endswith("]"):  # SID, e.g. [RMS Express-1.7.28.0-B2FHM$]
+				handler = self._handle_sid
+			if handler is not None:
+				handler(request)
 			else:
 				self.next_state = CLOSE_CONNECTION  # Close connection if request type is unrecognized
 		else:
@@ -207,123 +239,141 @@ class WinlinkConnection:
 
 	def _handle_comment(self, message):
 		"""Handle comment messages that begin with '; '."""
-		self._log_debug(f"Comment message: {message}")
+		self._log_debug("Comment message: %s", message)
 
 	def _handle_forward_message(self, message):
 		"""Handle forward messages that begin with ';FW:'."""
-		self._log_debug(f"Forward message: {message}")
+		self._log_debug("Forward message: %s", message)
 		# Implementation for handling forward message
 		# (Extract forward_login_callsign, pickup_callsigns, etc.)
 
 	def _handle_authentication_challenge(self, message):
-		self._log_debug(f"Authentication challenge: {message}")
+		self._log_debug("Authentication challenge: %s", message)
 		pass
 
 	def _handle_pending_message(self, message):
-		self._log_debug(f"Pending message: {message}")
+		self._log_debug("Pending message: %s", message)
 		pass
 
 	def _handle_sid(self, message):
 		"""Parse the message that starts with '[' and ends with ']'. Extract author, version, and feature list."""
-		self._log_debug(f"SID message: {message}")
+		self._log_debug("SID message: %s", message)
 		
 		# Remove the brackets and split by '-'
 		content = message[1:-1]  # Strip the surrounding brackets
-		parts = content.split('-')
-		
+		parts = content.split('-', 2)  # Author, version, features -- never more than three parts
+
 		if len(parts) >= 2:  # We expect at least author and feature list
 			self.author = parts[0]  # First parameter is the author
-			self.version = parts[1] if len(parts) > 2 else None  # Optional: Second parameter is the version (or None if missing)
-			self.feature_list = parts[2] if len(parts) > 2 else parts[1]  # Third parameter is the feature list, or version if no third part
+			self.version = parts[1] if len(parts) == 3 else None  # Optional: Second parameter is the version (or None if missing)
+			self.feature_list = parts[-1]  # Last parameter is the feature list
 
 			# Log the extracted parameters for debugging
-			self._log_debug(f"Author: {self.author}, Version: {self.version}, Feature List: {self.feature_list}")
+			self._log_debug("Author: %s, Version: %s, Feature List: %s", self.author, self.version, self.feature_list)
 		else:
-			self._log_debug(f"Server: Invalid SID format. Closing connection to {self.address}")
-			self._close_connection()  # Close the connection if format is incorrect
-			self.next_state = CLOSE_CONNECTION  # Close the connection
+			self._log_debug("Server: Invalid SID format. Closing connection to %s", self.address)
+			self.next_state = CLOSE_CONNECTION  # handle_connection closes the socket on the way out
 
 
 	def _handle_message_proposal(self, message):
 		"""Handle 'FC' case -- message proposal"""
-		self._log_debug(f"Message proposal: {message}")
+		self._log_debug("Message proposal: %s", message)
 		
 		# Extracting message type, message ID, uncompressed size, and compressed size
-		parts = message.split()
-		if len(parts) >= 5:
-			message_type = parts[1]
-			message_id = parts[2]
-			uncompressed_size = int(parts[3])
-			compressed_size = int(parts[4])
+		match = PROPOSAL_PATTERN.match(message)
+		if match:
+			message_type, message_id = match[1], match[2]
+			uncompressed_size = int(match[3])
+			compressed_size = int(match[4])
 
 			# Create a new Message instance with the extracted data
 			new_message = WinlinkMailMessage(message_type, message_id, uncompressed_size, compressed_size, enable_debug=self.enable_debug)
-			self.message_queue.put(new_message)
-			self._log_debug(f"Message added to queue: {new_message.message_id} (Type: {new_message.message_type})")
+			self.message_queue.append(new_message)
+			self._log_debug("Message added to queue: %s (Type: %s)", new_message.message_id, new_message.message_type)
 		
 		else:
 			self._log_debug("Invalid message proposal format")
 
 	def _handle_end_of_proposals(self, message):
 		"""Handle 'F>' case"""
-		self._log_debug(f"End of proposals")
+		self._log_debug("End of proposals")
 		
 		try:
-			pending_messages = len(self.message_queue.queue)
+			messages = list(self.message_queue)  # Take every proposal at once; the queue is empty again for the next batch
+			self.message_queue.clear()
+			pending_messages = len(messages)
+			size_hint = sum(B2Message.frame_size_hint(message.compressed_size) for message in messages)
 			if pending_messages > 0:
-				c = 'Y'
 				# Tell the client we are ready to accept all the pending messages
-				self.send_data(f"FS {c * pending_messages}\r")  
-				raw_message_data = self._wait_for_messages()  # One big binary blob for all messages
+				self.send_data(b"FS " + b"Y" * pending_messages + b"\r")
+				raw_message_data = self._wait_for_messages(pending_messages, size_hint)  # One big binary blob for all messages
 				next_index = 0  # Start index for processing the received data
 
-				while not self.message_queue.empty():
-					message = self.message_queue.get()  # Get the first message in the queue
-					self._log_debug(f"Processing message ID: {message.message_id}")
+				for message in messages:
+					self._log_debug("Processing message ID: %s", message.message_id)
 					message.capture(raw_message_data)  # Record the raw data
 					next_index = message.parse()  # Parse the message at the beginning of raw_message_data and figure out where the next one starts
-					message.save_message_to_files()
+					_mailbox_writer.submit(message.save_message_to_files)  # Saved in the background
 					raw_message_data = raw_message_data[next_index:]  # Remove the processed data from the buffer
 					
 				# Send "FF" followed by a carriage return after receiving the messages
-				self.send_data("FF\r")
+				self.send_data(MESSAGES_RECEIVED)
 			
 		except Exception as e:
-			self._log_debug(f"Error handling end of proposal: {e}")
-			self._close_connection()  # Close the connection in case of an error
+			self._log_debug("Error handling end of proposal: %s", e)
+			self.next_state = CLOSE_CONNECTION  # handle_connection closes the socket on the way out
 
 	def _handle_no_messages(self, message):
 		"""Handle the 'FF' request indicating no messages to process."""
-		self._log_debug(f"No message condition: {message}")
+		self._log_debug("No message condition: %s", message)
 		
 		# Send "FQ" followed by a carriage return
-		self.send_data("FQ\r")
+		self.send_data(NO_MORE_MESSAGES)
 		self._log_debug("Sent 'FQ' indicating no messages")
 
-	def _wait_for_messages(self):
-		"""Wait for all data from the client -- may include multiple messages"""
-		# received_data = b""
-		received_data = bytearray()
-		self._log_debug(f"Ready to receive message data from client")
+	def _wait_for_messages(self, message_count, size_hint=0):
+		"""Wait for the data of message_count messages from the client -- returns as soon as the last one is complete"""
+		# Data is received straight into one buffer sized from the proposals; it only grows if they undersold it
+		received_length = len(self._receive_buffer)
+		received_data = bytearray(max(min(size_hint, MESSAGE_BUFFER_START_MAX), received_length + 4096))
+		received_data[:received_length] = self._receive_buffer  # Starts with anything read ahead of the F> line
+		self._receive_buffer = bytearray()
+		frame_start = 0  # Index of the first message not yet fully received
+		self._log_debug("Ready to receive message data from client")
 		try:
 			while True:
-				# Receive in chunks (you can adjust the chunk size if necessary)
-				# chunk = self.connection.recv(min(4096, expected_size - len(received_data)))
-				chunk = self.connection.recv(4096)
-				if chunk is not None:
-					self._log_debug(f"Received chunk of length {len(chunk)}")
-				else:
-					break  # If no more data is received, exit the loop
-				received_data += chunk
-
-			# Log the data received
-			self._log_debug(f"Received {len(received_data)} bytes of data")
-			
-			return received_data
+				# Step over every message that is now complete
+				while message_count > 0:
+					frame_end = B2Message.frame_end(received_data, frame_start, received_length)
+					if frame_end is None:
+						break
+					frame_start = frame_end
+					message_count -= 1
+				if message_count == 0:
+					# Anything past the last message belongs to the next request
+					self._receive_buffer = received_data[frame_start:received_length]
+					received_length = frame_start
+					break
+
+				if received_length == len(received_data):
+					received_data += bytes(len(received_data))  # Double the buffer
+				chunk_length = self.connection.recv_into(memoryview(received_data)[received_length:])
+				if not chunk_length:
+					break  # The client closed the connection
+				self._log_debug("Received chunk of length %d", chunk_length)
+				received_length += chunk_length
 		except socket.timeout:
-			return received_data
+			self._log_debug("Timeout occurred while waiting for message data.")
+		except ValueError as e:
+			self._log_debug("Malformed message data: %s", e)  # Leave it to the parser to reject
+
+		del received_data[received_length:]  # Trim the unused tail of the buffer
+
+		# Log the data received
+		self._log_debug("Received %s bytes of data", len(received_data))
+		return received_data
 
 	def _close_connection(self):
 		if self.connection:
-			self.logger.info(f"Closing connection to {self.address}")
-			self.connection.close
+			self.logger.info("Closing connection to %s", self.address)
+			self.connection.close()
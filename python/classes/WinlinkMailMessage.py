@@ -15,6 +15,8 @@ from classes.B2Message import B2Message
 
 MAILBOX_FOLDER_NAME = "mailbox"
 
+os.makedirs(MAILBOX_FOLDER_NAME, exist_ok=True)  # Once per process rather than once per message
+
 
 class WinlinkMailMessage:
 	"""Class to represent a message with its metadata."""
@@ -29,22 +31,13 @@ class WinlinkMailMessage:
 		self.compressed_size = compressed_size  # Compressed size of the message
 		self.b2 = None
 
-		if not os.path.exists(MAILBOX_FOLDER_NAME):
-			os.makedirs(MAILBOX_FOLDER_NAME)
-
-		julian_date = self.time_created.strftime("%Y%m%d%H%M%S")
+		t = self.time_created  # Formatted directly -- same result as strftime("%Y%m%d%H%M%S") without the pattern parsing
+		julian_date = f"{t.year:04d}{t.month:02d}{t.day:02d}{t.hour:02d}{t.minute:02d}{t.second:02d}"
 		self.filename = f"{MAILBOX_FOLDER_NAME}/{julian_date}-{self.message_id}"
 
 		# Set up logging
 		self.logger = logging.getLogger(__name__)
-		self._setup_logging()
-
-	def _setup_logging(self):
-		"""Set up logging configuration."""
-		log_level = logging.DEBUG if self.enable_debug else logging.INFO
-		logging.basicConfig(level=log_level,
-							format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-		
+
 	def _log_debug(self, message):
 		"""Log debug messages if debugging is enabled."""
 		if self.enable_debug:
@@ -61,6 +54,16 @@ class WinlinkMailMessage:
 		# self._log_debug(f"B2 subject: {self.b2.subject}")
 		# self._save_raw_data_to_file()
 
+	def _write_file(self, filename, data):
+		"""Write data to filename straight through the file descriptor, without a buffered file object."""
+		fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+		try:
+			view = memoryview(data)
+			while view:
+				view = view[os.write(fd, view):]  # Usually a single write
+		finally:
+			os.close(fd)
+
 	def save_message_to_files(self):
 		"""Save the raw data and the decoded data to files."""
 		try:
@@ -74,8 +77,7 @@ class WinlinkMailMessage:
 		"""Save the raw data to a .b2f file."""
 		try:
 			raw_filename = f"{self.filename}.b2f"
-			with open(raw_filename, 'wb') as f:
-				f.write(self.b2.raw_data)
+			self._write_file(raw_filename, memoryview(self.b2.raw_data)[:self.b2.raw_length])  # Only this message's frame, without copying it
 			self._log_debug(f"Raw data saved to {raw_filename}")
 		except Exception as e:
 			self._log_debug(f"Error saving raw data: {e}")
@@ -85,8 +87,7 @@ class WinlinkMailMessage:
 		if self.b2.headers is not None:
 			try:
 				headers_filename = f"{self.filename}-headers.txt"
-				with open(headers_filename, 'w') as f:
-					f.write(self.b2.headers)
+				self._write_file(headers_filename, self.b2.headers.encode('ascii'))  # Already ASCII-only; skip the text I/O layer
 				self._log_debug(f"Headers saved to {headers_filename}")
 			except Exception as e:
 				self._log_debug(f"Error saving headers: {e}")
@@ -98,8 +99,7 @@ class WinlinkMailMessage:
 		if self.b2.body is not None:
 			try:
 				body_filename = f"{self.filename}-body.txt"
-				with open(body_filename, 'w') as f:
-					f.write(self.b2.body)
+				self._write_file(body_filename, self.b2.body)  # Bytes as received; no decode/encode round trip
 				self._log_debug(f"Body saved to {body_filename}")
 			except Exception as e:
 				self._log_debug(f"Error saving body: {e}")
@@ -111,8 +111,7 @@ class WinlinkMailMessage:
 		try:
 			for attachment in self.b2.attachments:
 				attachment_filename = f"{self.filename}-{attachment.filename}"
-				with open(attachment_filename, 'wb') as f:
-					f.write(attachment.data)
+				self._write_file(attachment_filename, attachment.data)
 				self._log_debug(f"Attachment saved to {attachment_filename}")
 		except Exception as e:
 			self._log_debug(f"Error saving attachments: {e}")
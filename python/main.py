@@ -8,47 +8,68 @@ __maintainer__ = __author__
 __email__ = "bob@rail.com"
 __status__ = "Experimental"
 
+import logging
 import socket
-import threading
+from concurrent.futures import ThreadPoolExecutor
 from classes.WinlinkConnection import WinlinkConnection
 
 LISTEN_IP = "0.0.0.0"
 LISTEN_PORT = 8772
-SIMULTANEOUS_CONNECTION_MAX = 5
+SIMULTANEOUS_CONNECTION_MAX = 32  # Connections handled at once; further clients wait their turn
+LISTEN_BACKLOG = 128
 CONNECTION_READ_TIMEOUT_SECONDS = 1
+RECEIVE_BUFFER_BYTES = 1 << 20  # Room for a whole message upload in the kernel
 
 
 class WinlinkServer:
-	def __init__(self, host=LISTEN_IP, port=LISTEN_PORT):
+	def __init__(self, host=LISTEN_IP, port=LISTEN_PORT, enable_debug=True):
 		"""Initialize the server with default host and port."""
 		self.host = host
 		self.port = port
+		self.enable_debug = enable_debug
+		self.connection_pool = ThreadPoolExecutor(max_workers=SIMULTANEOUS_CONNECTION_MAX, thread_name_prefix="winlink-connection")
+
+		# Set up logging
+		self.logger = logging.getLogger(__name__)
+		self._setup_logging()
+
+	def _setup_logging(self):
+		"""Set up logging configuration."""
+		log_level = logging.DEBUG if self.enable_debug else logging.INFO
+		logging.basicConfig(level=log_level,
+							format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 	def start_server(self):
 		"""Main listening loop that accepts new connections."""
 		server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		# Set before listen() so accepted sockets inherit it and can advertise a large window
+		server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+		server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Restart without waiting out TIME_WAIT
 		try:
 			server_socket.bind((self.host, self.port))
 		except socket.error as e:
-			print(f"Error binding to {self.host}:{self.port} - {e}")
+			self.logger.error("Error binding to %s:%s - %s", self.host, self.port, e)
 			return
-		server_socket.listen(SIMULTANEOUS_CONNECTION_MAX)  
-		print(f"Server is listening on {self.host}:{self.port}")
+		server_socket.listen(LISTEN_BACKLOG)
+		self.logger.info("Server is listening on %s:%s", self.host, self.port)
 
 		try:
 			while True:
 				# Accept a new connection
 				connection, address = server_socket.accept()
-				print(f"Connection established with {address}")
+				self.logger.debug("Connection established with %s", address)
+				# Prompts and replies are short lines -- don't let Nagle hold them back
+				connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-				# Fork a new thread to handle the connection
-				handler = WinlinkConnection(connection, address, timeout=CONNECTION_READ_TIMEOUT_SECONDS, enable_debug=True)
-				threading.Thread(target=handler.handle_connection).start()
+				# Hand the connection to a pooled thread
+				handler = WinlinkConnection(connection, address, timeout=CONNECTION_READ_TIMEOUT_SECONDS, enable_debug=self.enable_debug)
+				self.connection_pool.submit(handler.handle_connection)
 		
 		except KeyboardInterrupt:
-			print("Winlink Server interrupted, shutting down...")
+			self.logger.info("Winlink Server interrupted, shutting down...")
 		finally:
 			server_socket.close()
+			self.connection_pool.shutdown(wait=True)  # Let connections in progress finish
 
 if __name__ == "__main__":
 	server = WinlinkServer()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''Checks B2 frame boundary detection and the read-ahead handling around message uploads'''
+
+__author__ = "Bob Iannucci"
+__copyright__ = "Copyright 2025, Bob Iannucci"
+__license__ = "MIT"
+__maintainer__ = __author__
+__email__ = "bob@rail.com"
+__status__ = "Experimental"
+
+import sys
+import os
+
+this_path = os.path.dirname(__file__)
+src_path = os.path.abspath(os.path.join(this_path, '../'))
+sys.path.insert(0, src_path)
+
+import socket
+import unittest
+from classes.B2Message import B2Message
+from classes.WinlinkConnection import WinlinkConnection
+
+with open(f'{this_path}/testdata/MQ2TOYZRMM2D.b2f', 'rb') as f:
+	SAMPLE_FRAME = f.read()
+SAMPLE_COMPRESSED_SIZE = 22314
+
+
+class FrameEndTest(unittest.TestCase):
+	def test_one_complete_frame(self):
+		self.assertEqual(B2Message.frame_end(SAMPLE_FRAME), len(SAMPLE_FRAME))
+
+	def test_two_frames_back_to_back(self):
+		frame_length = len(SAMPLE_FRAME)
+		data = bytearray(SAMPLE_FRAME * 2)
+		self.assertEqual(B2Message.frame_end(data, 0), frame_length)
+		self.assertEqual(B2Message.frame_end(data, frame_length), 2 * frame_length)
+
+	def test_truncated_frame_is_incomplete(self):
+		# Cut inside the subject, inside a data block, between EOT and checksum
+		for cut in (3, 1000, len(SAMPLE_FRAME) - 1):
+			self.assertIsNone(B2Message.frame_end(SAMPLE_FRAME[:cut]), f"cut at {cut}")
+			self.assertIsNone(B2Message.frame_end(SAMPLE_FRAME, 0, cut), f"end at {cut}")
+
+	def test_malformed_frame_is_rejected(self):
+		with self.assertRaises(ValueError):
+			B2Message.frame_end(b"X" + SAMPLE_FRAME[1:])
+
+
+class WaitForMessagesTest(unittest.TestCase):
+	def setUp(self):
+		self.server_side, self.client_side = socket.socketpair()
+		self.connection = WinlinkConnection(self.server_side, ("test", 0), 1)
+
+	def tearDown(self):
+		self.server_side.close()
+		self.client_side.close()
+
+	def test_bytes_after_last_frame_are_kept(self):
+		self.client_side.sendall(SAMPLE_FRAME + b"FF\r")
+		received = self.connection._wait_for_messages(1, B2Message.frame_size_hint(SAMPLE_COMPRESSED_SIZE))
+		self.assertEqual(bytes(received), SAMPLE_FRAME)
+		self.assertEqual(bytes(self.connection._receive_buffer), b"FF\r")
+		self.assertEqual(self.connection.wait_for_input(), "FF")
+
+	def test_read_ahead_is_used_first(self):
+		split = 500
+		self.connection._receive_buffer = bytearray(SAMPLE_FRAME[:split])  # As if read along with the F> line
+		self.client_side.sendall(SAMPLE_FRAME[split:] + SAMPLE_FRAME + b"FQ\r")
+		received = self.connection._wait_for_messages(2)
+		self.assertEqual(bytes(received), SAMPLE_FRAME * 2)
+		self.assertEqual(bytes(self.connection._receive_buffer), b"FQ\r")
+
+
+if __name__ == "__main__":
+	unittest.main()